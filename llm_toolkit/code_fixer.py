@@ -15,11 +15,13 @@
 """Fixing fuzz target with LLM."""
 
 import argparse
+import functools
 import logging
 import os
 import re
 import sys
-from typing import Callable, Optional
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Iterable, Optional
 
 from data_prep.project_context import context_introspector
 from experiment import benchmark as benchmarklib
@@ -41,6 +43,32 @@ FALSE_FUZZED_DATA_PROVIDER_ERROR = 'include/fuzzer/FuzzedDataProvider.h:16:10:'
 FALSE_EXTERN_KEYWORD_ERROR = 'expected identifier or \'(\'\nextern "C"'
 FDP_INCLUDE_STATEMENT = '#include <fuzzer/FuzzedDataProvider.h>'
 
+# Patterns used when parsing build logs, compiled once at import time since
+# they are matched against every line of potentially large logs.
+ERROR_END_PATTERN = re.compile(r'.*\d+ errors? generated.\n?')
+# Classifies an error line as a clang diagnostic or an include trace in a
+# single match.
+ERROR_LINE_PATTERN = re.compile(
+    r'(?P<diag>(?P<diag_src>\S*):\d+:\d+: (?P<severity>.+): (.+))|'
+    r'(?P<include>In file included from (?P<include_src>\S*):\d+:)')
+
+# Builtin libraries and the probes for their functions used by a fuzz target.
+BUILTIN_LIBRARY_TABLE = (
+    ('#include <stdlib.h>', re.compile(r'\b(?:malloc|calloc|free)\b')),
+    ('#include <string.h>', re.compile(r'\bmemcpy\b')),
+)
+PNGRIO_FUNCTION_PATTERN = re.compile(
+    r'\b(?:png_read_data|png_default_read_data)\b')
+# Lines calling functions that do not exist in libpng-proto.
+NONEXIST_PNG_FUNCTION_PATTERN = re.compile(
+    r'.*(?:png_init_io|png_set_write_fn|png_set_compression_level|'
+    r'.png_write_).*')
+PNG_CONST_PATTERN = re.compile(r'png_const_')
+
+# A specific fix takes the target content and returns the chunks to prepend to
+# it along with the (possibly rewritten) content.
+SpecificFix = Callable[[str], tuple[list[str], str]]
+
 
 def parse_args():
   """Parses command line arguments."""
@@ -91,18 +119,29 @@ def parse_args():
 
 def get_target_files(target_dir: str) -> list[str]:
   """Returns the fuzz target files in the raw target directory."""
-  return [
-      os.path.join(target_dir, f)
-      for f in os.listdir(target_dir)
-      if benchmarklib.is_c_file(f) or benchmarklib.is_cpp_file(f)
-  ]
+  target_file_types = (benchmarklib.FileType.C, benchmarklib.FileType.CPP)
+  with os.scandir(target_dir) as entries:
+    return [
+        entry.path
+        for entry in entries
+        if entry.is_file() and
+        benchmarklib.get_file_type(entry.name) in target_file_types
+    ]
 
 
-def collect_specific_fixes(project: str,
-                           file_name: str) -> list[Callable[[str], str]]:
+def collect_specific_fixes(project: str, file_name: str) -> list[SpecificFix]:
   """Returns a list code fix functions given the language and |project|."""
+  return list(
+      _collect_specific_fixes_by_type(project,
+                                      benchmarklib.get_file_type(file_name)))
+
+
+@functools.lru_cache(maxsize=None)
+def _collect_specific_fixes_by_type(
+    project: str, file_type: benchmarklib.FileType) -> tuple[SpecificFix, ...]:
+  """Returns the code fix functions given the |file_type| and |project|."""
   required_fixes = set()
-  if benchmarklib.is_cpp_file(file_name):
+  if file_type == benchmarklib.FileType.CPP:
     required_fixes = required_fixes.union([
         append_extern_c,
         insert_cstdint,
@@ -110,7 +149,7 @@ def collect_specific_fixes(project: str,
     ])
 
   # TODO(Dongge): Remove this.
-  if benchmarklib.is_c_file(file_name):
+  if file_type == benchmarklib.FileType.C:
     required_fixes = required_fixes.union([
         insert_stdint,
         include_builtin_library,
@@ -124,107 +163,110 @@ def collect_specific_fixes(project: str,
         remove_const_from_png_symbols,
     ])
 
-  return list(required_fixes)
+  return tuple(required_fixes)
 
 
 def apply_specific_fixes(content: str,
-                         required_fixes: list[Callable[[str], str]]) -> str:
+                         required_fixes: list[SpecificFix]) -> str:
   """Fixes frequent errors in |raw_content| and returns fixed content."""
+  # Prepended chunks are joined once at the end instead of copying the whole
+  # content for every include a fix adds.
+  prefix_chunks = []
   for required_fix in required_fixes:
-    content = required_fix(content)
-
-  return content
+    chunks, content = required_fix(content)
+    # Chunks from later fixes go on top, as if prepended to the content.
+    prefix_chunks[:0] = chunks
+
+  if not prefix_chunks:
+    return content
+  return ''.join(prefix_chunks) + content
+
+
+def _fix_target(file: str, project: str) -> None:
+  """Reads raw content of |file|, applies fixes, and saves the fixed content."""
+  with open(file) as raw_file:
+    raw_content = raw_file.read()
+  specific_fixes = collect_specific_fixes(project, file)
+  fixed_content = apply_specific_fixes(raw_content, specific_fixes)
+  if fixed_content == raw_content:
+    return
+  with open(file, 'w') as fixed_file:
+    fixed_file.write(fixed_content)
 
 
 def fix_all_targets(target_dir: str, project: str):
   """Reads raw content, applies fixes, and saves the fixed content."""
-  for file in get_target_files(target_dir):
-    with open(file) as raw_file:
-      raw_content = raw_file.read()
-    specific_fixes = collect_specific_fixes(project, file)
-    fixed_content = apply_specific_fixes(raw_content, specific_fixes)
-    with open(os.path.join(target_dir, os.path.basename(file)),
-              'w+') as fixed_file:
-      fixed_file.write(fixed_content)
+  target_files = get_target_files(target_dir)
+  if len(target_files) <= 1:
+    for file in target_files:
+      _fix_target(file, project)
+    return
+
+  # Targets are fixed independently, and the regex fixes are CPU-bound.
+  with ProcessPoolExecutor() as executor:
+    list(
+        executor.map(_fix_target, target_files,
+                     [project] * len(target_files)))
 
 
 # ========================= Specific Fixes ========================= #
-def append_extern_c(raw_content: str) -> str:
+def append_extern_c(raw_content: str) -> tuple[list[str], str]:
   """Appends `extern "C"` before fuzzer entry `LLVMFuzzerTestOneInput`."""
   pattern = r'int LLVMFuzzerTestOneInput'
+  # A substring check is much cheaper than a regex scan when nothing matches.
+  if pattern not in raw_content:
+    return [], raw_content
   replacement = f'extern "C" {pattern}'
   fixed_content = re.sub(pattern, replacement, raw_content)
-  return fixed_content
+  return [], fixed_content
 
 
-def insert_cstdlib(raw_content: str) -> str:
+def insert_cstdlib(raw_content: str) -> tuple[list[str], str]:
   """Includes `cstdlib` library."""
-  fixed_content = f'#include <cstdlib>\n{raw_content}'
-  return fixed_content
+  return ['#include <cstdlib>\n'], raw_content
 
 
-def insert_cstdint(raw_content: str) -> str:
+def insert_cstdint(raw_content: str) -> tuple[list[str], str]:
   """Includes `cstdint` library."""
-  fixed_content = f'#include <cstdint>\n{raw_content}'
-  return fixed_content
+  return ['#include <cstdint>\n'], raw_content
 
 
-def insert_stdint(content: str) -> str:
+def insert_stdint(content: str) -> tuple[list[str], str]:
   """Includes `stdint` library."""
   include_stdint = '#include <stdint.h>\n'
   if include_stdint not in content:
-    content = f'{include_stdint}{content}'
-  return content
+    return [include_stdint], content
+  return [], content
 
 
-def remove_nonexist_png_functions(content: str) -> str:
+def remove_nonexist_png_functions(content: str) -> tuple[list[str], str]:
   """Removes non-exist functions in libpng-proto."""
-  non_exist_functions = [
-      r'.*png_init_io.*',
-      r'.*png_set_write_fn.*',
-      r'.*png_set_compression_level.*',
-      r'.*.png_write_.*',
-  ]
-  for pattern in non_exist_functions:
-    content = re.sub(pattern, '', content)
-  return content
+  if 'png_' not in content:
+    return [], content
+  return [], NONEXIST_PNG_FUNCTION_PATTERN.sub('', content)
 
 
-def include_builtin_library(content: str) -> str:
+def include_builtin_library(content: str) -> tuple[list[str], str]:
   """Includes builtin libraries when its function was invoked."""
-  library_function_dict = {
-      '#include <stdlib.h>': [
-          'malloc',
-          'calloc',
-          'free',
-      ],
-      '#include <string.h>': ['memcpy',]
-  }
-  for library, functions in library_function_dict.items():
-    use_lib_functions = any(f in content for f in functions)
-    if use_lib_functions and not library in content:
-      content = f'{library}\n{content}'
-  return content
-
-
-def include_pngrio(content: str) -> str:
+  includes = ''.join(f'{library}\n'
+                     for library, pattern in BUILTIN_LIBRARY_TABLE
+                     if library not in content and pattern.search(content))
+  return ([includes] if includes else []), content
+
+
+def include_pngrio(content: str) -> tuple[list[str], str]:
   """Includes <pngrio.c> when using its functions."""
-  functions = [
-      'png_read_data',
-      'png_default_read_data',
-  ]
-  use_pngrio_funcitons = any(f in content for f in functions)
+  use_pngrio_funcitons = PNGRIO_FUNCTION_PATTERN.search(content) is not None
   include_pngrio_stmt = '#include "pngrio.c"'
 
   if use_pngrio_funcitons and not include_pngrio_stmt in content:
-    content = f'{include_pngrio}\n{content}'
-  return content
+    return [f'{include_pngrio_stmt}\n'], content
+  return [], content
 
 
-def remove_const_from_png_symbols(content: str) -> str:
+def remove_const_from_png_symbols(content: str) -> tuple[list[str], str]:
   """Removes const from png types."""
-  re.sub(r'png_const_', 'png_', content)
-  return content
+  return [], PNG_CONST_PATTERN.sub('png_', content)
 
 
 # ========================= LLM Fixes ========================= #
@@ -235,17 +277,16 @@ def extract_error_message(log_path: str, project_target_basename: str,
   """Extracts error message and its context from the file in |log_path|."""
 
   with open(log_path) as log_file:
-    # A more accurate way to extract the error message.
-    log_lines = log_file.readlines()
-
-  errors = extract_error_from_lines(log_lines, project_target_basename,
-                                    language)
+    # Stream the log lines so that only the error window is kept in memory.
+    errors = extract_error_from_lines(log_file, project_target_basename,
+                                      language)
   if not errors:
     logger.warning('Failed to parse error message from %s.', log_path)
   return errors
 
 
-def extract_error_from_lines(log_lines: list[str], project_target_basename: str,
+def extract_error_from_lines(log_lines: Iterable[str],
+                             project_target_basename: str,
                              language: str) -> list[str]:
   """Extracts error message and its context from the file in |log_path|."""
   # Error message extraction for Java projects
@@ -282,13 +323,15 @@ def extract_error_from_lines(log_lines: list[str], project_target_basename: str,
 
   target_name, _ = os.path.splitext(project_target_basename)
 
-  error_lines_range: list[Optional[int]] = [None, None]
-  temp_range: list[Optional[int]] = [None, None]
+  # Only the lines of the latest clang diagnostics block are buffered.
+  error_block: list[str] = []
+  temp_block: Optional[list[str]] = None
 
-  error_start_pattern = r'\S*' + target_name + r'(\.\S*)?:\d+:\d+: .+: .+\n?'
-  error_include_pattern = (r'In file included from \S*' + target_name +
-                           r'(\.\S*)?:\d+:\n?')
-  error_end_pattern = r'.*\d+ errors? generated.\n?'
+  # These depend on |target_name|, compile them once for all log lines.
+  error_start_pattern = re.compile(r'\S*' + target_name +
+                                   r'(\.\S*)?:\d+:\d+: .+: .+\n?')
+  error_include_pattern = re.compile(r'In file included from \S*' +
+                                     target_name + r'(\.\S*)?:\d+:\n?')
 
   error_keywords = [
       'multiple definition of',
@@ -296,7 +339,10 @@ def extract_error_from_lines(log_lines: list[str], project_target_basename: str,
   ]
   errors = []
   unique_symbol = set()
-  for i, line in enumerate(log_lines):
+  for line in log_lines:
+    if temp_block is not None:
+      temp_block.append(line)
+
     # Add GNU ld errors in interest.
     found_keyword = False
     for keyword in error_keywords:
@@ -312,21 +358,17 @@ def extract_error_from_lines(log_lines: list[str], project_target_basename: str,
       continue
 
     # Add clang/clang++ diagnostics.
-    if (temp_range[0] is None and (re.fullmatch(error_include_pattern, line) or
-                                   re.fullmatch(error_start_pattern, line))):
-      temp_range[0] = i
-    if temp_range[0] is not None and re.fullmatch(error_end_pattern, line):
-      temp_range[1] = i - 1  # Exclude current line.
+    if (temp_block is None and (error_include_pattern.fullmatch(line) or
+                                error_start_pattern.fullmatch(line))):
+      temp_block = [line]
+    if temp_block is not None and ERROR_END_PATTERN.fullmatch(line):
       # In case the original fuzz target was written in C and building with
       # clang failed, and building with clang++ also failed, we take the
       # error from clang++, which comes after.
-      error_lines_range = temp_range
-      temp_range = [None, None]
+      error_block = temp_block[:-1]  # Exclude current line.
+      temp_block = None
 
-  if error_lines_range[0] is not None and error_lines_range[1] is not None:
-    errors.extend(
-        line.rstrip()
-        for line in log_lines[error_lines_range[0]:error_lines_range[1] + 1])
+  errors.extend(line.rstrip() for line in error_block)
 
   return group_error_messages(errors)
 
@@ -337,57 +379,52 @@ def group_error_messages(error_lines: list[str]) -> list[str]:
   state_include = 'INCLUDE'
   state_diag = 'DIAG'
 
-  diag_error_pattern = re.compile(r'(\S*):\d+:\d+: (.+): (.+)')
-  include_error_pattern = re.compile(r'In file included from (\S*):\d+:')
-  error_blocks = []
-  curr_block = []
+  error_lines = [line for line in error_lines if line]  # Trim empty lines.
+  # Blocks are contiguous, so track their boundaries and join them at the end.
+  block_ranges = []
+  block_start = 0
   src_file = ''
   curr_state = state_unknown
-  for line in error_lines:
-    if not line:  # Trim empty lines.
-      continue
-
-    diag_match = diag_error_pattern.fullmatch(line)
-    include_match = include_error_pattern.fullmatch(line)
+  for i, line in enumerate(error_lines):
+    line_match = ERROR_LINE_PATTERN.fullmatch(line)
+    line_kind = line_match.lastgroup if line_match else None
+    diag_match = line_match if line_kind == 'diag' else None
+    include_match = line_match if line_kind == 'include' else None
 
     if diag_match:
-      err_src = diag_match.group(1)
-      severity = diag_match.group(2)
+      err_src = diag_match.group('diag_src')
+      severity = diag_match.group('severity')
 
       # Matched a note diag line under another diag,
       # giving help info to fix the previous error.
       if severity == 'note':
-        curr_block.append(line)
         continue
 
       # Matched a diag line but under an included file line,
       # indicating the specific error in the included file,
       if curr_state == state_include and err_src != src_file:
-        curr_block.append(line)
         continue
 
       curr_state = state_diag
-      if curr_block:
-        error_blocks.append('\n'.join(curr_block))
-        curr_block = []
+      if block_start < i:
+        block_ranges.append((block_start, i))
+        block_start = i
 
     if include_match:
-      src_file = include_match.group(1)
+      src_file = include_match.group('include_src')
       curr_state = state_include
-      if curr_block:
-        error_blocks.append('\n'.join(curr_block))
-        curr_block = []
+      if block_start < i:
+        block_ranges.append((block_start, i))
+        block_start = i
 
     # Keep unknown error lines separated.
-    if curr_state == state_unknown and curr_block:
-      error_blocks.append('\n'.join(curr_block))
-      curr_block = []
-
-    curr_block.append(line)
+    if curr_state == state_unknown and block_start < i:
+      block_ranges.append((block_start, i))
+      block_start = i
 
-  if curr_block:
-    error_blocks.append('\n'.join(curr_block))
-  return error_blocks
+  if block_start < len(error_lines):
+    block_ranges.append((block_start, len(error_lines)))
+  return ['\n'.join(error_lines[start:end]) for start, end in block_ranges]
 
 
 def llm_fix(ai_binary: str, target_path: str, benchmark: benchmarklib.Benchmark,
@@ -412,28 +449,30 @@ def llm_fix(ai_binary: str, target_path: str, benchmark: benchmarklib.Benchmark,
                 fixer_model_name,
                 temperature=0.5 - llm_fix_id * 0.04)
 
-  fixed_code_candidates = []
+  # TODO(Dongge): Use the common vote:
+  # LLM gives multiple responses to one query. In many experiments, I
+  # found the code compartment of some of the responses are exactly the same. In
+  # these cases, we can use the most common code of all responses as it could be
+  # a safer choice. Currently, we prefer the longest code to encourage code
+  # complexity.
+  # TODO(Dongge): Exclude the candidate if it is identical to the original
+  # code.
+  # Only the longest fix so far is kept, other candidates are discarded as soon
+  # as they are parsed.
+  preferred_fix_path, preferred_fix_code = None, ''
   for file in os.listdir(response_dir):
     if not parser.is_raw_output(file):
       continue
     fixed_code_path = os.path.join(response_dir, file)
     fixed_code = parser.parse_code(fixed_code_path)
-    fixed_code_candidates.append([fixed_code_path, fixed_code])
+    if (preferred_fix_path is None or
+        len(fixed_code) > len(preferred_fix_code)):
+      preferred_fix_path, preferred_fix_code = fixed_code_path, fixed_code
 
-  if not fixed_code_candidates:
+  if preferred_fix_path is None:
     logger.info('LLM did not generate rawoutput for %s', prompt_path)
     return
 
-  # TODO(Dongge): Use the common vote:
-  # LLM gives multiple responses to one query. In many experiments, I
-  # found the code compartment of some of the responses are exactly the same. In
-  # these cases, we can use the most common code of all responses as it could be
-  # a safer choice. Currently, we prefer the longest code to encourage code
-  # complexity.
-  # TODO(Dongge): Exclude the candidate if it is identical to the original
-  # code.
-  preferred_fix_path, preferred_fix_code = max(fixed_code_candidates,
-                                               key=lambda x: len(x[1]))
   logger.info('Will use the longest fix: %s',
               os.path.relpath(preferred_fix_path))
   preferred_fix_name, _ = os.path.splitext(preferred_fix_path)